@@ -1,17 +1,72 @@
 from __future__ import annotations
 
+import asyncio
+import hashlib
 import json
+import logging
+import mmap
 import os
 import pathlib
-import urllib.error
-import urllib.request
+import queue
+import sqlite3
+import time
+from collections import OrderedDict
+from logging.handlers import QueueHandler, QueueListener
 from http import HTTPStatus
-from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
-from typing import Any
-from urllib.parse import urlparse
+from typing import Any, AsyncIterator
+
+import aiohttp
+import numpy as np
+from aiohttp import web
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - stdlib fallback
+    orjson = None  # type: ignore[assignment]
 
 BASE_DIR = pathlib.Path(__file__).resolve().parent
 SYSTEM_PROMPT = ""
+KNOWLEDGE_BASE = ""
+
+_LOGGER = logging.getLogger("chatbot")
+
+# RAG settings: the KB is chunked and embedded once at startup; each request
+# then only pays prompt tokens for the chunks relevant to the question.
+_CHUNK_CHARS = 800
+_RAG_TOP_K = 4
+_EMBEDDINGS_CACHE = BASE_DIR / "kb_embeddings.npy"
+_EMBEDDINGS_META = BASE_DIR / "kb_embeddings.json"
+
+# Exact-match reply cache: repeated FAQ-style questions skip the LLM call
+# entirely. Keyed on the model plus the normalized conversation so a hit is
+# only served when the full context matches.
+_REPLY_CACHE: OrderedDict[tuple[Any, ...], str] = OrderedDict()
+_REPLY_CACHE_MAX = 512
+
+_CORS_HEADERS = {
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Allow-Headers": "Content-Type",
+    "Access-Control-Allow-Methods": "GET,POST,OPTIONS",
+}
+
+
+def _setup_logging() -> QueueListener:
+    """Route log records through a queue so handlers never block on stderr.
+
+    Writes are flushed by a background listener thread; request coroutines
+    only pay for an enqueue.
+    """
+    log_queue: queue.SimpleQueue[Any] = queue.SimpleQueue()
+    stream = logging.StreamHandler()
+    stream.setFormatter(
+        logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s")
+    )
+    listener = QueueListener(log_queue, stream)
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.addHandler(QueueHandler(log_queue))
+    listener.start()
+    return listener
 
 
 def _load_dotenv(dotenv_path: pathlib.Path) -> None:
@@ -31,8 +86,18 @@ def _load_dotenv(dotenv_path: pathlib.Path) -> None:
 
 
 def _read_knowledge_base(path: pathlib.Path) -> str:
+    # Memory-map instead of read(): the kernel pages the file in directly and
+    # the only heap allocation is the single decoded str.
     try:
-        return path.read_text(encoding="utf-8")
+        with open(path, "rb") as f:
+            try:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # Empty files cannot be mapped. Decode errors, by contrast,
+                # must propagate, so only the mmap call sits in this try.
+                return ""
+            with mm:
+                return str(memoryview(mm), "utf-8")
     except FileNotFoundError as e:
         raise RuntimeError(f"Knowledge file not found: {path}") from e
 
@@ -52,17 +117,161 @@ def _build_system_prompt(knowledge_base: str) -> str:
     )
 
 
-def _json_response(handler: SimpleHTTPRequestHandler, status: int, payload: Any) -> None:
-    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
-    handler.send_response(status)
-    handler.send_header("Content-Type", "application/json; charset=utf-8")
-    handler.send_header("Content-Length", str(len(body)))
-    handler.send_header("Cache-Control", "no-store")
-    handler.end_headers()
-    handler.wfile.write(body)
+def _split_chunks(text: str, max_chars: int = _CHUNK_CHARS) -> list[str]:
+    """Split the knowledge base into line-aligned chunks of about max_chars."""
+    chunks: list[str] = []
+    current: list[str] = []
+    current_len = 0
+    for line in text.splitlines():
+        if current and current_len + len(line) > max_chars:
+            chunks.append("\n".join(current))
+            current = []
+            current_len = 0
+        current.append(line)
+        current_len += len(line) + 1
+    if current:
+        chunks.append("\n".join(current))
+    return [c for c in chunks if c.strip()]
+
+
+def _embeddings_config() -> tuple[str, str, str]:
+    """Return (base_url, api_key, model) for the embeddings endpoint.
+
+    OpenRouter does not serve /embeddings, so embeddings default to the
+    OpenAI API proper and require OPENAI_API_KEY.
+    """
+    base_url = os.getenv("EMBEDDINGS_BASE_URL", "https://api.openai.com/v1").strip()
+    api_key = os.getenv("OPENAI_API_KEY", "").strip()
+    model = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small").strip()
+    return base_url, api_key, model
+
+
+async def _embed_texts(
+    session: aiohttp.ClientSession,
+    *,
+    base_url: str,
+    api_key: str,
+    model: str,
+    texts: list[str],
+    timeout_s: int = 60,
+) -> np.ndarray:
+    """Embed texts via an OpenAI-compatible /embeddings endpoint.
+
+    Returns an L2-normalized (len(texts), dim) float32 matrix, so cosine
+    similarity reduces to a dot product.
+    """
+    url = f"{base_url.rstrip('/')}/embeddings"
+    payload = {"model": model, "input": texts}
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {api_key}",
+    }
+    try:
+        async with session.post(
+            url,
+            data=_json_dumps(payload),
+            headers=headers,
+            timeout=aiohttp.ClientTimeout(total=timeout_s),
+        ) as response:
+            raw = await response.read()
+            if response.status >= 400:
+                raise RuntimeError(
+                    f"Embeddings error ({response.status}): "
+                    f"{raw.decode('utf-8', errors='replace')}"
+                )
+    except aiohttp.ClientError as e:
+        raise RuntimeError(f"Failed to reach embeddings endpoint: {e}") from e
+    except asyncio.TimeoutError as e:
+        raise RuntimeError(f"Embeddings endpoint timed out after {timeout_s}s.") from e
+
+    parsed = _json_loads(raw)
+    try:
+        vectors = [item["embedding"] for item in parsed["data"]]
+    except (TypeError, LookupError) as e:
+        raise RuntimeError(f"Unexpected embeddings response: {parsed}") from e
+
+    matrix = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0.0] = 1.0
+    return matrix / norms
+
+
+class _KnowledgeIndex:
+    """In-memory vector index over the knowledge-base chunks."""
+
+    def __init__(self, chunks: list[str], matrix: np.ndarray) -> None:
+        self.chunks = chunks
+        self.matrix = matrix
+
+    def top_chunks(self, query_vec: np.ndarray, k: int = _RAG_TOP_K) -> list[str]:
+        similarities = self.matrix @ query_vec
+        order = np.argsort(similarities)[::-1][:k]
+        # Preserve document order so the prompt reads like the source text.
+        return [self.chunks[i] for i in sorted(order)]
+
 
+async def _build_knowledge_index(
+    session: aiohttp.ClientSession, knowledge_base: str
+) -> _KnowledgeIndex | None:
+    """Chunk and embed the KB, reusing the on-disk cache when it is current."""
+    base_url, api_key, model = _embeddings_config()
+    if not api_key:
+        _LOGGER.warning("RAG disabled: OPENAI_API_KEY not set; using the full KB prompt.")
+        return None
 
-def _openai_compatible_chat_completion(
+    chunks = _split_chunks(knowledge_base)
+    if not chunks:
+        return None
+    kb_hash = hashlib.sha256(knowledge_base.encode("utf-8")).hexdigest()
+
+    if _EMBEDDINGS_CACHE.exists() and _EMBEDDINGS_META.exists():
+        try:
+            meta = _json_loads(_EMBEDDINGS_META.read_bytes())
+            if meta.get("hash") == kb_hash and meta.get("model") == model:
+                matrix = np.load(_EMBEDDINGS_CACHE)
+                if matrix.shape[0] == len(chunks):
+                    return _KnowledgeIndex(chunks, matrix)
+        except (ValueError, OSError):
+            pass
+
+    try:
+        matrix = await _embed_texts(
+            session, base_url=base_url, api_key=api_key, model=model, texts=chunks
+        )
+    except RuntimeError as e:
+        _LOGGER.warning("RAG disabled: %s", e)
+        return None
+
+    np.save(_EMBEDDINGS_CACHE, matrix)
+    _EMBEDDINGS_META.write_bytes(_json_dumps({"hash": kb_hash, "model": model}))
+    return _KnowledgeIndex(chunks, matrix)
+
+
+def _json_dumps(obj: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+
+def _json_loads(data: str | bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _json_response(status: int, payload: Any) -> web.Response:
+    body = _json_dumps(payload)
+    return web.Response(
+        status=status,
+        body=body,
+        content_type="application/json",
+        charset="utf-8",
+        headers={"Cache-Control": "no-store"},
+    )
+
+
+async def _openai_compatible_chat_stream(
+    session: aiohttp.ClientSession,
     *,
     base_url: str,
     api_key: str,
@@ -71,37 +280,152 @@ def _openai_compatible_chat_completion(
     temperature: float,
     extra_headers: dict[str, str] | None = None,
     timeout_s: int = 60,
-) -> str:
+) -> AsyncIterator[str]:
+    """Yield content deltas from an OpenAI-compatible SSE streaming completion."""
     url = f"{base_url.rstrip('/')}/chat/completions"
     payload = {
         "model": model,
         "messages": messages,
         "temperature": temperature,
+        "stream": True,
     }
-    data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
 
-    request = urllib.request.Request(url=url, data=data, method="POST")
-    request.add_header("Content-Type", "application/json")
-    request.add_header("Authorization", f"Bearer {api_key}")
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {api_key}",
+    }
     if extra_headers:
         for k, v in extra_headers.items():
             if v:
-                request.add_header(k, v)
+                headers[k] = v
 
     try:
-        with urllib.request.urlopen(request, timeout=timeout_s) as response:
-            raw = response.read().decode("utf-8", errors="replace")
-    except urllib.error.HTTPError as e:
-        raw = e.read().decode("utf-8", errors="replace")
-        raise RuntimeError(f"Upstream error ({e.code}): {raw}") from e
-    except urllib.error.URLError as e:
+        async with session.post(
+            url,
+            data=_json_dumps(payload),
+            headers=headers,
+            timeout=aiohttp.ClientTimeout(total=timeout_s),
+        ) as response:
+            if response.status >= 400:
+                raw = await response.text()
+                raise RuntimeError(f"Upstream error ({response.status}): {raw}")
+            async for raw_line in response.content:
+                line = raw_line.decode("utf-8", errors="replace").strip()
+                if not line.startswith("data:"):
+                    continue
+                frame = line[len("data:"):].strip()
+                if frame == "[DONE]":
+                    break
+                try:
+                    parsed = _json_loads(frame)
+                    delta = parsed["choices"][0].get("delta", {}).get("content")
+                except (ValueError, LookupError):
+                    continue
+                if delta:
+                    yield delta
+    except aiohttp.ClientError as e:
         raise RuntimeError(f"Failed to reach upstream: {e}") from e
+    except asyncio.TimeoutError as e:
+        raise RuntimeError(f"Upstream timed out after {timeout_s}s.") from e
+
+
+class _HedgeBudget:
+    """Token bucket capping hedges at a fraction of primary traffic.
+
+    Each primary call earns `ratio` tokens and a hedge spends one, so
+    during a provider-wide slowdown — when every request would otherwise
+    hedge — duplicate volume stays bounded at ~ratio of primary calls
+    instead of doubling load on an already-struggling provider.
+    """
+
+    def __init__(self, ratio: float = 0.2, burst: float = 10.0) -> None:
+        self._ratio = ratio
+        self._burst = burst
+        self._tokens = burst
+
+    def note_primary(self) -> None:
+        self._tokens = min(self._burst, self._tokens + self._ratio)
+
+    def try_acquire(self) -> bool:
+        if self._tokens >= 1.0:
+            self._tokens -= 1.0
+            return True
+        return False
+
+
+_HEDGE_BUDGET = _HedgeBudget()
+
+
+async def _hedged_chat_stream(
+    session: aiohttp.ClientSession,
+    *,
+    hedge_delay_s: float,
+    **kwargs: Any,
+) -> AsyncIterator[str]:
+    """Stream a completion, hedging with a duplicate call against tail latency.
+
+    If the primary call hasn't produced its first delta within
+    hedge_delay_s, an identical second call is launched and whichever
+    stream starts first is used; the loser is cancelled. Provider p95/p99
+    latency is dominated by queueing, so the duplicate usually lands on a
+    less-loaded replica. Hedges draw on _HEDGE_BUDGET; when the bucket is
+    empty the slow primary is simply awaited.
+    """
+
+    async def start() -> tuple[str | None, AsyncIterator[str]]:
+        stream = _openai_compatible_chat_stream(session, **kwargs)
+        return await anext(stream, None), stream
+
+    if hedge_delay_s <= 0:
+        async for delta in _openai_compatible_chat_stream(session, **kwargs):
+            yield delta
+        return
 
-    parsed = json.loads(raw)
+    _HEDGE_BUDGET.note_primary()
+    primary = asyncio.create_task(start())
+    backup: asyncio.Task[tuple[str | None, AsyncIterator[str]]] | None = None
     try:
-        return parsed["choices"][0]["message"]["content"].strip()
-    except Exception as e:
-        raise RuntimeError(f"Unexpected upstream response: {parsed}") from e
+        done, _ = await asyncio.wait({primary}, timeout=hedge_delay_s)
+        if not done and _HEDGE_BUDGET.try_acquire():
+            backup = asyncio.create_task(start())
+
+        tasks = {t for t in (primary, backup) if t is not None}
+        winner: asyncio.Task[tuple[str | None, AsyncIterator[str]]] | None = None
+        pending = {t for t in tasks if not t.done()}
+        if primary.done():
+            winner = primary
+        while winner is None:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                if task.exception() is None:
+                    winner = task
+                    break
+            else:
+                if not pending:
+                    raise done.pop().exception()  # type: ignore[misc]
+
+        for task in tasks - {winner}:
+            if task.done():
+                if task.exception() is None:
+                    _, stream = task.result()
+                    await stream.aclose()
+            else:
+                task.cancel()
+
+        first, stream = winner.result()
+        if first is not None:
+            yield first
+        async for delta in stream:
+            yield delta
+    finally:
+        for task in (primary, backup):
+            if task is not None and not task.done():
+                task.cancel()
+
+
+_ALLOWED_ROLES = frozenset(("user", "assistant"))
 
 
 def _validate_messages(payload: Any) -> list[dict[str, str]]:
@@ -117,7 +441,7 @@ def _validate_messages(payload: Any) -> list[dict[str, str]]:
             raise ValueError("Each message must be an object.")
         role = item.get("role")
         content = item.get("content")
-        if role not in {"user", "assistant"}:
+        if role not in _ALLOWED_ROLES:
             raise ValueError("Each message.role must be 'user' or 'assistant'.")
         if not isinstance(content, str) or not content.strip():
             raise ValueError("Each message.content must be a non-empty string.")
@@ -128,96 +452,429 @@ def _validate_messages(payload: Any) -> list[dict[str, str]]:
     return cleaned
 
 
-class ChatbotHandler(SimpleHTTPRequestHandler):
-    def __init__(self, *args: Any, **kwargs: Any) -> None:
-        super().__init__(*args, directory=str(BASE_DIR), **kwargs)
-
-    def end_headers(self) -> None:
-        self.send_header("Access-Control-Allow-Origin", "*")
-        self.send_header("Access-Control-Allow-Headers", "Content-Type")
-        self.send_header("Access-Control-Allow-Methods", "GET,POST,OPTIONS")
-        super().end_headers()
-
-    def do_OPTIONS(self) -> None:  # noqa: N802
-        self.send_response(HTTPStatus.NO_CONTENT)
-        self.end_headers()
-
-    def do_GET(self) -> None:  # noqa: N802
-        parsed = urlparse(self.path)
-        if parsed.path == "/api/health":
-            _json_response(self, HTTPStatus.OK, {"ok": True})
-            return
-        if parsed.path == "/":
-            self.path = "/index.html"
-        super().do_GET()
-
-    def do_POST(self) -> None:  # noqa: N802
-        parsed = urlparse(self.path)
-        if parsed.path != "/api/chat":
-            self.send_error(HTTPStatus.NOT_FOUND, "Not Found")
-            return
-
-        content_length = int(self.headers.get("Content-Length", "0") or "0")
-        if content_length <= 0 or content_length > 1_000_000:
-            _json_response(
-                self,
-                HTTPStatus.BAD_REQUEST,
-                {"error": "Invalid Content-Length."},
-            )
-            return
+# Opening of the scripted reply the system prompt mandates when the answer is
+# not in the knowledge base. A reply starting with this marker means the small
+# model found nothing, which is the escalation signal for the tiered router.
+_KB_MISS_MARKER = "申し訳ございません。提供された情報には"
+
+
+async def _probe_kb_miss(
+    deltas: AsyncIterator[str],
+) -> tuple[bool, list[str], AsyncIterator[str]]:
+    """Buffer the smallest reply prefix that decides whether the KB was missed.
+
+    Accumulates deltas only while the text is still a prefix of the miss
+    marker, so normal replies typically pass through after the first delta.
+    Returns (missed, buffered deltas, remaining stream).
+    """
+    parts: list[str] = []
+    length = 0
+    async for delta in deltas:
+        parts.append(delta)
+        length += len(delta)
+        acc = "".join(parts)
+        if length >= len(_KB_MISS_MARKER):
+            return acc.startswith(_KB_MISS_MARKER), parts, deltas
+        if not _KB_MISS_MARKER.startswith(acc):
+            return False, parts, deltas
+    return False, parts, deltas
+
+
+def _trim_history(
+    messages: list[dict[str, str]], max_messages: int
+) -> list[dict[str, str]]:
+    """Keep only the most recent messages so prompt tokens stay bounded.
+
+    The window is aligned to start on a user turn so the model never sees a
+    conversation opening with its own reply.
+    """
+    if max_messages <= 0 or len(messages) <= max_messages:
+        return messages
+    trimmed = messages[-max_messages:]
+    while trimmed and trimmed[0]["role"] == "assistant":
+        trimmed = trimmed[1:]
+    return trimmed
+
+
+def _cache_key(model: str, messages: list[dict[str, str]]) -> tuple[Any, ...]:
+    return (
+        model,
+        tuple(
+            (m["role"], " ".join(m["content"].split()).casefold()) for m in messages
+        ),
+    )
+
+
+def _cache_get(key: tuple[Any, ...]) -> str | None:
+    reply = _REPLY_CACHE.get(key)
+    if reply is not None:
+        _REPLY_CACHE.move_to_end(key)
+    return reply
+
+
+def _cache_put(key: tuple[Any, ...], reply: str) -> None:
+    _REPLY_CACHE[key] = reply
+    _REPLY_CACHE.move_to_end(key)
+    while len(_REPLY_CACHE) > _REPLY_CACHE_MAX:
+        _REPLY_CACHE.popitem(last=False)
+
+
+class _ChatStore:
+    """Durable per-session conversation memory backed by SQLite.
+
+    WAL mode keeps writers from blocking readers and synchronous=NORMAL
+    avoids an fsync per message; a lost last message on power failure is an
+    acceptable trade for chat history.
+    """
+
+    def __init__(self, path: pathlib.Path) -> None:
+        self._conn = sqlite3.connect(
+            str(path), check_same_thread=False, isolation_level=None
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            "  id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            "  session_id TEXT NOT NULL,"
+            "  role TEXT NOT NULL,"
+            "  content TEXT NOT NULL,"
+            "  created_at REAL NOT NULL"
+            ")"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_messages_session"
+            " ON messages (session_id, id)"
+        )
+
+    def append(self, session_id: str, role: str, content: str) -> None:
+        self._conn.execute(
+            "INSERT INTO messages (session_id, role, content, created_at)"
+            " VALUES (?, ?, ?, ?)",
+            (session_id, role, content, time.time()),
+        )
+
+    def recent(self, session_id: str, limit: int) -> list[dict[str, str]]:
+        rows = self._conn.execute(
+            "SELECT role, content FROM messages"
+            " WHERE session_id = ? ORDER BY id DESC LIMIT ?",
+            (session_id, limit),
+        ).fetchall()
+        return [{"role": role, "content": content} for role, content in reversed(rows)]
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+def _record_turn(
+    app: web.Application, session_id: str | None, question: str, reply: str
+) -> None:
+    if session_id is None or not reply:
+        return
+    store: _ChatStore = app["chat_store"]
+    store.append(session_id, "user", question)
+    store.append(session_id, "assistant", reply)
+
+
+def _validate_session_id(payload: dict[str, Any]) -> str | None:
+    session_id = payload.get("session_id")
+    if session_id is None:
+        return None
+    if not isinstance(session_id, str) or not session_id.strip():
+        raise ValueError("Body.session_id must be a non-empty string.")
+    if len(session_id) > 128:
+        raise ValueError("Body.session_id is too long.")
+    return session_id.strip()
 
+
+def _settle_inflight(
+    app: web.Application,
+    key: tuple[Any, ...] | None,
+    *,
+    reply: str | None = None,
+    error: BaseException | None = None,
+) -> None:
+    """Resolve the shared future for a coalesced request, if we own one."""
+    if key is None:
+        return
+    future = app["inflight"].pop(key, None)
+    if future is None or future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+        # Mark retrieved so an unawaited future doesn't log a traceback.
+        future.exception()
+    else:
+        future.set_result(reply)
+
+
+def _is_private_path(path: str) -> bool:
+    """Paths the static handler must never serve (conversation data)."""
+    if path == "/data" or path.startswith("/data/"):
+        return True
+    return pathlib.PurePosixPath(path).name.startswith("chats.db")
+
+
+@web.middleware
+async def _private_files_middleware(
+    request: web.Request, handler: Any
+) -> web.StreamResponse:
+    if _is_private_path(request.path):
+        return _json_response(HTTPStatus.NOT_FOUND, {"error": "Not Found"})
+    return await handler(request)
+
+
+@web.middleware
+async def _cors_middleware(request: web.Request, handler: Any) -> web.StreamResponse:
+    if request.method == "OPTIONS":
+        response: web.StreamResponse = web.Response(status=HTTPStatus.NO_CONTENT)
+    else:
         try:
-            raw = self.rfile.read(content_length).decode("utf-8", errors="replace")
-            payload = json.loads(raw)
-            user_messages = _validate_messages(payload)
+            response = await handler(request)
+        except web.HTTPException as e:
+            # Error responses raised by the dispatcher (404, 405, ...) must
+            # carry CORS headers too, as the old end_headers override did.
+            e.headers.update(_CORS_HEADERS)
+            raise
+    response.headers.update(_CORS_HEADERS)
+    return response
+
+
+async def handle_health(request: web.Request) -> web.Response:
+    return _json_response(HTTPStatus.OK, {"ok": True})
+
+
+async def handle_index(request: web.Request) -> web.FileResponse:
+    return web.FileResponse(BASE_DIR / "index.html")
+
 
-            api_key = os.getenv("OPENROUTER_API_KEY") or os.getenv("OPENAI_API_KEY") or ""
+async def handle_chat(request: web.Request) -> web.StreamResponse:
+    owned_key: tuple[Any, ...] | None = None
+    try:
+        try:
+            payload = _json_loads(await request.read())
+            user_messages = _validate_messages(payload)
+            session_id = _validate_session_id(payload)
+            max_history = int(os.getenv("MAX_HISTORY_MESSAGES", "20"))
+            if session_id is not None:
+                # With server-side memory the context comes from the store
+                # plus the new user message; client-sent history is ignored.
+                latest = user_messages[-1]
+                if latest["role"] != "user":
+                    raise ValueError(
+                        "Last message must be a user message when session_id is set."
+                    )
+                stored = request.app["chat_store"].recent(session_id, max_history)
+                user_messages = [*stored, latest]
+            user_messages = _trim_history(user_messages, max_history)
+
+            api_key = (
+                os.getenv("OPENROUTER_API_KEY") or os.getenv("OPENAI_API_KEY") or ""
+            )
             if not api_key.strip():
                 raise RuntimeError(
                     "Missing OPENROUTER_API_KEY (or OPENAI_API_KEY). Set it in .env."
                 )
 
-            base_url = os.getenv("OPENAI_BASE_URL", "https://openrouter.ai/api/v1").strip()
+            base_url = os.getenv(
+                "OPENAI_BASE_URL", "https://openrouter.ai/api/v1"
+            ).strip()
             model = os.getenv("OPENROUTER_MODEL", "openai/gpt-4o-mini").strip()
+            large_model = os.getenv("OPENROUTER_MODEL_LARGE", "openai/gpt-4o").strip()
+            hedge_delay_s = float(os.getenv("HEDGE_DELAY_S", "1.5"))
 
             extra_headers = {
                 "HTTP-Referer": os.getenv("OPENROUTER_HTTP_REFERER", "").strip(),
                 "X-Title": os.getenv("OPENROUTER_X_TITLE", "").strip(),
             }
 
-            reply = _openai_compatible_chat_completion(
+            cache_key = _cache_key(model, user_messages)
+            cached = _cache_get(cache_key)
+            if cached is not None:
+                _record_turn(
+                    request.app, session_id, user_messages[-1]["content"], cached
+                )
+                return web.Response(
+                    status=HTTPStatus.OK,
+                    text=cached,
+                    content_type="text/plain",
+                    charset="utf-8",
+                    headers={"Cache-Control": "no-store"},
+                )
+
+            # Coalesce concurrent identical questions: followers await the
+            # leader's upstream call instead of issuing a duplicate.
+            inflight: dict[tuple[Any, ...], asyncio.Future[str]] = request.app[
+                "inflight"
+            ]
+            waiter = inflight.get(cache_key)
+            if waiter is not None:
+                reply = await asyncio.shield(waiter)
+                _record_turn(
+                    request.app, session_id, user_messages[-1]["content"], reply
+                )
+                return web.Response(
+                    status=HTTPStatus.OK,
+                    text=reply,
+                    content_type="text/plain",
+                    charset="utf-8",
+                    headers={"Cache-Control": "no-store"},
+                )
+            inflight[cache_key] = asyncio.get_running_loop().create_future()
+            owned_key = cache_key
+
+            system_prompt = SYSTEM_PROMPT
+            index = request.app.get("kb_index")
+            if index is not None:
+                try:
+                    emb_base_url, emb_api_key, emb_model = _embeddings_config()
+                    query_matrix = await _embed_texts(
+                        request.app["client_session"],
+                        base_url=emb_base_url,
+                        api_key=emb_api_key,
+                        model=emb_model,
+                        texts=[user_messages[-1]["content"]],
+                    )
+                    context = "\n\n".join(index.top_chunks(query_matrix[0]))
+                    system_prompt = _build_system_prompt(context)
+                except RuntimeError:
+                    # Retrieval is an optimization; fall back to the full KB.
+                    system_prompt = SYSTEM_PROMPT
+
+            messages = [{"role": "system", "content": system_prompt}, *user_messages]
+            deltas = _hedged_chat_stream(
+                request.app["client_session"],
+                hedge_delay_s=hedge_delay_s,
                 base_url=base_url,
                 api_key=api_key.strip(),
                 model=model,
-                messages=[{"role": "system", "content": SYSTEM_PROMPT}, *user_messages],
+                messages=messages,
                 temperature=0.1,
                 extra_headers=extra_headers,
             )
 
-            _json_response(self, HTTPStatus.OK, {"reply": reply})
+            # Pulling the first deltas before committing to a streamed
+            # response lets upstream failures still surface as JSON errors.
+            missed, buffered, deltas = await _probe_kb_miss(deltas)
+            if missed and large_model and large_model != model:
+                # The small model found nothing in the KB; retry once on the
+                # larger model before giving the user the scripted apology.
+                await deltas.aclose()
+                deltas = _hedged_chat_stream(
+                    request.app["client_session"],
+                    hedge_delay_s=hedge_delay_s,
+                    base_url=base_url,
+                    api_key=api_key.strip(),
+                    model=large_model,
+                    messages=messages,
+                    temperature=0.1,
+                    extra_headers=extra_headers,
+                )
+                first = await anext(deltas, "")
+                buffered = [first] if first else []
         except (ValueError, json.JSONDecodeError) as e:
-            _json_response(self, HTTPStatus.BAD_REQUEST, {"error": str(e)})
+            _settle_inflight(request.app, owned_key, error=e)
+            return _json_response(HTTPStatus.BAD_REQUEST, {"error": str(e)})
         except Exception as e:
-            _json_response(self, HTTPStatus.INTERNAL_SERVER_ERROR, {"error": str(e)})
+            _settle_inflight(request.app, owned_key, error=e)
+            return _json_response(HTTPStatus.INTERNAL_SERVER_ERROR, {"error": str(e)})
+
+        response = web.StreamResponse(
+            status=HTTPStatus.OK,
+            headers={
+                "Content-Type": "text/plain; charset=utf-8",
+                "Cache-Control": "no-store",
+            },
+        )
+        try:
+            response.enable_chunked_encoding()
+            await response.prepare(request)
+            parts: list[str] = []
+            head = "".join(buffered)
+            if head:
+                parts.append(head)
+                await response.write(head.encode("utf-8"))
+            async for delta in deltas:
+                parts.append(delta)
+                await response.write(delta.encode("utf-8"))
+            await response.write_eof()
+        except BaseException as e:
+            _settle_inflight(request.app, owned_key, error=e)
+            raise
+        reply = "".join(parts)
+        if reply:
+            _cache_put(cache_key, reply)
+            _record_turn(request.app, session_id, user_messages[-1]["content"], reply)
+        _settle_inflight(request.app, owned_key, reply=reply)
+        return response
+    finally:
+        # Safety net for anything that escaped the handlers above (client
+        # disconnect during prepare, task cancellation, ...): fail the shared
+        # future so coalesced followers never hang on a dead leader. A no-op
+        # when the future was already settled.
+        _settle_inflight(
+            request.app,
+            owned_key,
+            error=RuntimeError("Request aborted before a reply was produced."),
+        )
+
+
+async def _on_startup(app: web.Application) -> None:
+    # One pooled session for the process so TCP+TLS handshakes to the
+    # upstream API amortize across requests.
+    app["client_session"] = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=100, keepalive_timeout=75),
+    )
+    app["kb_index"] = await _build_knowledge_index(app["client_session"], KNOWLEDGE_BASE)
+    db_path = pathlib.Path(
+        os.getenv("CHAT_DB_PATH", str(BASE_DIR / "data" / "chats.db"))
+    )
+    db_path.parent.mkdir(parents=True, exist_ok=True)
+    app["chat_store"] = _ChatStore(db_path)
+
+
+async def _on_cleanup(app: web.Application) -> None:
+    app["chat_store"].close()
+    await app["client_session"].close()
+
+
+def create_app() -> web.Application:
+    app = web.Application(middlewares=[_cors_middleware, _private_files_middleware])
+    app["inflight"] = {}
+    app.router.add_get("/api/health", handle_health)
+    app.router.add_post("/api/chat", handle_chat)
+    app.router.add_get("/", handle_index)
+    app.router.add_static("/", BASE_DIR)
+    app.on_startup.append(_on_startup)
+    app.on_cleanup.append(_on_cleanup)
+    return app
 
 
 def main() -> int:
     _load_dotenv(BASE_DIR / ".env")
+    listener = _setup_logging()
 
     port = int(os.getenv("PORT", "8000"))
     host = os.getenv("HOST", "127.0.0.1")
 
     knowledge_base = _read_knowledge_base(BASE_DIR / "website_data.txt")
-    global SYSTEM_PROMPT
+    global SYSTEM_PROMPT, KNOWLEDGE_BASE
+    KNOWLEDGE_BASE = knowledge_base
     SYSTEM_PROMPT = _build_system_prompt(knowledge_base)
 
-    server = ThreadingHTTPServer((host, port), ChatbotHandler)
+    # Per-request access logging is a syscall per hit; keep it opt-in.
+    access_log = (
+        logging.getLogger("aiohttp.access") if os.getenv("ACCESS_LOG") == "1" else None
+    )
+
     print(f"Serving on http://{host}:{port}  (GET /, POST /api/chat)")
     try:
-        server.serve_forever()
-    except KeyboardInterrupt:
-        print("\nShutting down...")
-        return 0
+        web.run_app(
+            create_app(), host=host, port=port, print=None, access_log=access_log
+        )
+    finally:
+        listener.stop()
+    return 0
 
 
 if __name__ == "__main__":
@@ -1,9 +1,11 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from bs4 import BeautifulSoup
 import os
 
 # --- 設定 ---
-TARGET_URL = "https://sites.google.com/view/tokyo-probability-seminar23/2025年度" 
+TARGET_URL = "https://sites.google.com/view/tokyo-probability-seminar23/2025年度"
 OUTPUT_FILE = "website_data.txt"
 
 # 1. User-Agentを設定し、ブラウザからのアクセスに見せかける
@@ -11,14 +13,32 @@ HEADERS = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
 }
 
+# 3. Sessionを使い回してTLSハンドシェイクを節約し、一時的なエラーは自動リトライする
+#    （429はRetry-Afterヘッダーを尊重して待ってから再試行する）
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=32,
+        pool_maxsize=32,
+        max_retries=Retry(
+            total=2,
+            backoff_factor=0.2,
+            status_forcelist=(429, 500, 502, 503, 504),
+            respect_retry_after_header=True,
+        ),
+    ),
+)
+
 # --- 関数定義 ---
 def scrape_website_text(url):
     """
     指定されたURLからHTMLを取得し、テキストコンテンツを抽出する関数
     """
     try:
-        # 2. 修正: headers=HEADERS を追加してアクセス
-        response = requests.get(url, headers=HEADERS)
+        # 2. 修正: Session経由でアクセス（User-Agentヘッダー込み）
+        response = SESSION.get(url)
         
         # デバッグ: ステータスコードをターミナルに表示
         print(f"DEBUG: HTTP Status Code: {response.status_code}")